@@ -3,27 +3,106 @@
 # POP Tracer Budget: compute tracer budget terms
 
 import os 
+import shutil
+import functools
+import hashlib
+import fnmatch
+import dask
 import xarray as xr
 import numpy as np
 from glob import glob
-from dask.diagnostics import ProgressBar
+from dask.utils import parse_bytes
+from numba import guvectorize, njit
+
+# fastmath without "nnan"/"ninf": the z-integral kernels test for NaN cells
+_FASTMATH = {"nsz", "arcp", "contract", "afn", "reassoc"}
 
 #*****************************************************************************#
+# indice {diretorio: arquivos} dos diretorios que casam com dirname (relativo
+# a cwd, que entra na chave: um os.chdir() nao reaproveita listagens),
+# lido uma unica vez por sessao (stat de diretorio e caro em Lustre/GPFS)
+@functools.lru_cache(maxsize=None)
+def _file_index (cwd, dirname):
+    return {d: sorted(os.listdir(d)) for d in glob(os.path.join(cwd, dirname))\
+            if os.path.isdir(d)}
+
+# como glob(pattern), mas listando cada diretorio apenas uma vez: mesmos
+# caminhos (forma dada, nome simples sem diretorio) e, como glob, arquivos
+# ocultos apenas se o nome no pattern comeca com "."
+def _glob_indexed (pattern):
+    dirname, fname = os.path.split(pattern)
+    cwd = os.getcwd()
+    files = []
+    for d, names in _file_index(cwd, dirname).items():
+        if not fname.startswith("."):
+            names = [f for f in names if not f.startswith(".")]
+        if not os.path.isabs(dirname):
+            d = d[len(os.path.join(cwd, "")):]   # de volta a forma relativa
+        files += [os.path.join(d, f) for f in fnmatch.filter(names, fname)]
+    return sorted(files)
+
 def get_filelist (basedir, scenario, freq, realm, varname):
-    filelist = glob(basedir + "/" + scenario + "/" + realm + "/" +\
-                    freq + "/" + varname + "/b.e11." + scenario + "*.nc")
+    filelist = _glob_indexed(basedir + "/" + scenario + "/" + realm + "/" +\
+                             freq + "/" + varname + "/b.e11." + scenario + "*.nc")
     return sorted(filelist)
 
 # devolve um arquivo/lista de arquivos de uma variavel e ens_member
 def get_filemember (basedir, scenario, freq, realm, ens_member, varname):
-    return sorted(glob(basedir + "/" + scenario + "/" + realm + "/" + freq + "/" + \
-                varname + "/b.e11." + scenario + ".f09_g16." + ens_member + ".pop.h.*.nc"))
+    return _glob_indexed(basedir + "/" + scenario + "/" + realm + "/" + freq + "/" + \
+                varname + "/b.e11." + scenario + ".f09_g16." + ens_member + ".pop.h.*.nc")
 
 # recebe um arquivo/lista de arquivos e devolve um dataset
 def read_cesm_pop (file, chunk_sz):
     return xr.open_mfdataset(file,decode_times=False,mask_and_scale=True,\
-                             concat_dim="time",data_vars="minimal",chunks={'time': chunk_sz})
+                             combine="by_coords",parallel=True,\
+                             data_vars="minimal",chunks={'time': chunk_sz})
+
+# tamanho do chunk dask no eixo time: ~target bytes por chunk (se chunk_sz
+# for None), multiplo dos chunks netCDF/HDF5 da variavel
+@functools.lru_cache(maxsize=64)
+def _time_chunk (file, var_name, chunk_sz, target):
+    with xr.open_dataset(file[0],decode_times=False) as ds:
+        var = ds[var_name]
+        chunksizes = var.encoding.get("chunksizes")
+        disk_sz = chunksizes[0] if chunksizes and var.dims[0] == "time" else 1
+        if chunk_sz is None:
+            chunk_sz = target // var.isel(time=0).nbytes
+    return max(disk_sz, chunk_sz // disk_sz * disk_sz)
+
+# um unico dataset (dask) por lista de arquivos e tamanho de chunk
+@functools.lru_cache(maxsize=64)
+def _read_cesm_pop_cached (file, chunk_sz):
+    return read_cesm_pop(list(file), chunk_sz)
+
+# remove as coordenadas do U-grid (ULAT, ULONG), nao usadas pelo budget
+def _drop_ugrid_coords (obj):
+    return obj.drop_vars([c for c in ("ULAT","ULONG") if c in obj.coords])
+
+# abre a(s) variavel(is) do budget com chunks multiplos dos chunks do disco e
+# do tamanho de array.chunk-size do dask (128 MiB por padrao), mantendo
+# apenas var_name e as variaveis em keep
+def _open_budget_var (file, var_name, chunk_sz=None, keep=()):
+    if isinstance(file, os.PathLike):
+        file = os.fspath(file)
+    if isinstance(file, str):
+        file = _glob_indexed(file)
+    file = tuple(sorted(os.fspath(f) for f in file))
+    if not file:
+        raise OSError("no files to open")
+    target = parse_bytes(dask.config.get("array.chunk-size"))
+    chunk_sz = _time_chunk(file, var_name, chunk_sz, target)
+    ds = _read_cesm_pop_cached(file, chunk_sz)
+    return _drop_ugrid_coords(ds[[var_name] + list(keep)])
 #*****************************************************************************#
+def _finalize (da, name, attrs):
+    """
+    Sets name/attrs of a budget term and casts it to float32 for output
+    """
+    da = da.astype("float32", copy=False)
+    da.name = name
+    da.attrs = attrs
+    return da
+
 def pop_decode_time (var): 
     varname = var.name
     time = var.time
@@ -38,18 +117,60 @@ def rmMonAnnCyc (var):
     return anomalies.drop("month")
 
 #*****************************************************************************#
-def tracer_budget_vol3d (tarea, dz, kmt):
+def _vol3d_fingerprint (*arrays):
+    """
+    sha1 of the shapes, dtypes and values of the (small) vol3d inputs
     """
-    Arguments: cell area, cell height, max vertical indx
-    Returns global 3D volume DataArray: vold3(nz,ny,nx) dtype=float64
+    h = hashlib.sha1()
+    for a in arrays:
+        a = np.ascontiguousarray(a.values)
+        h.update(str((a.shape, a.dtype.str)).encode())
+        h.update(a.tobytes())
+    return h.hexdigest()
+
+def _cache_vol3d (vol3d, path, fingerprint):
+    """
+    Writes vol3d to a Zarr store (once) and returns it read back from there.
+    The store keeps the fingerprint of the inputs (tarea, dz, kmt) in its
+    attrs and is rewritten if it does not match; writes go to a temporary
+    store renamed into place, so a crashed write is never reused.
+    Stored as a single chunk: the z-integral kernels take whole (z,y,x) blocks
+    """
+    path = path.rstrip("/")
+    if os.path.exists(path):
+        try:
+            cached = xr.open_zarr(path)
+        except (OSError, KeyError, ValueError):
+            cached = None
+        if cached is not None and vol3d.name in cached and \
+           cached.attrs.get("fingerprint") == fingerprint:
+            return cached[vol3d.name]
+        shutil.rmtree(path)
+    tmp_path = path + ".tmp-" + str(os.getpid())
+    if os.path.exists(tmp_path):
+        shutil.rmtree(tmp_path)
+    vol3d = vol3d.chunk({"z_t": -1, "nlat": -1, "nlon": -1})
+    ds = vol3d.to_dataset()
+    ds.attrs["fingerprint"] = fingerprint
+    ds.to_zarr(tmp_path)
+    os.replace(tmp_path, path)
+    return xr.open_zarr(path)[vol3d.name]
+
+def tracer_budget_vol3d (tarea, dz, kmt, store=None):
+    """
+    Arguments: cell area, cell height, max vertical indx,
+               store : optional Zarr path where vol3d is cached
+    Returns global 3D volume DataArray: vold3(nz,ny,nx) dtype=float32
     NOTE: does not include SSH variations
     """
-    vol3d = (dz*tarea.astype('float64')).load()
-    for i in range(dz.shape[0]):
-        vol3d[i,:,:] = vol3d[i].where(kmt > i, 0.)
+    # level index k, broadcast against kmt: T-cell is ocean where kmt > k
+    k_idx = xr.DataArray(np.arange(dz.size), dims=("z_t",))
+    vol3d = (dz.astype('float32')*tarea.astype('float32')).where(kmt > k_idx, 0.)
     vol3d.attrs = {'units' : 'cm3', 'long_name' : 'Tcell volume'}
-    vol3d = vol3d.drop(('ULAT','ULONG'))
+    vol3d = _drop_ugrid_coords(vol3d)
     vol3d.name = "vol3d"
+    if store is not None:
+        vol3d = _cache_vol3d(vol3d, store, _vol3d_fingerprint(tarea, dz, kmt))
     return vol3d
 
 #*****************************************************************************#
@@ -57,18 +178,53 @@ def tracer_budget_mask2d (region_mask, sel_area = 0):
     """
     Return surface mask: if ocean than 1 else nan
     """
-    mask = region_mask
-    mask = mask.where(region_mask != sel_area,np.nan)
-    return (mask/mask)
+    ocean = region_mask.notnull() & (region_mask != 0) & (region_mask != sel_area)
+    mask = xr.where(ocean, np.float32(1.), np.float32(np.nan))
+    return mask.rename("mask")
 
 #*****************************************************************************#
 def tracer_budget_mask3d (var3d):
     """
     Return volume mask: if ocean than 1 else nan
     """
-    mask3d = var3d/var3d
+    ocean = var3d.notnull() & (var3d != 0.)
+    mask3d = xr.where(ocean, np.float32(1.), np.float32(np.nan))
     mask3d.attrs = {'units' : '1 / np.nan', 'long_name' : 'mask3d'}
-    return mask3d.where(mask3d != 0.,np.nan)
+    return mask3d
+
+#*****************************************************************************#
+@njit(fastmath=_FASTMATH)
+def _zint_kernel (var, vol):
+    """
+    Arguments: var(t,z,y,x), vol(z,y,x)
+    Returns Int_z{var*vol}(t,y,x) accumulated in float64; NaN cells are
+    skipped, as in xarray's sum, and zero integrals (land) are NaN.
+    Serial: dask already runs one block per thread
+    """
+    # separate C-contiguous arrays, x innermost: unit-stride (SIMD) loads
+    var = np.ascontiguousarray(var)
+    vol = np.ascontiguousarray(vol)
+    nt, nz, ny, nx = var.shape
+    out = np.empty((nt, ny, nx))
+    acc = np.empty(nx)
+    for t in range(nt):
+        for j in range(ny):
+            acc[:] = 0.
+            for k in range(nz):
+                for i in range(nx):
+                    v = var[t,k,j,i]
+                    if not np.isnan(v):
+                        acc[i] += np.float64(v)*vol[k,j,i]
+            for i in range(nx):
+                out[t,j,i] = acc[i] if acc[i] != 0. else np.nan
+    return out
+
+def _zint (var, vol):
+    """
+    _zint_kernel for var(...,z,y,x) with any number of leading dims (incl. none)
+    """
+    out = _zint_kernel(var.reshape(-1, *var.shape[-3:]), vol)
+    return out.reshape(var.shape[:-3] + out.shape[-2:])
 
 #*****************************************************************************#
 def tracer_budget_var3d_zint_map (tracer, vol3d, klo=0, khi=25):
@@ -82,14 +238,34 @@ def tracer_budget_var3d_zint_map (tracer, vol3d, klo=0, khi=25):
     long_name = tracer.name + " vertical average"
     attr = {"long_name" : long_name, "units" : units, "description": description, \
             "k_range" : str(klo)+" - "+str(khi)}
-    var = tracer.isel(z_t=slice(klo,khi)) * vol3d.isel(z_t=slice(klo,khi))
-    var_zint_map = var.sum(dim="z_t")
+    var = _drop_ugrid_coords(tracer.isel(z_t=slice(klo,khi)))
+    vol = vol3d.isel(z_t=slice(klo,khi))
+    # multiply and reduce over z_t in one pass: no 4D (t,z,y,x) product
+    var_zint_map = xr.apply_ufunc(_zint, var, vol,\
+                                  input_core_dims=[["z_t","nlat","nlon"]]*2,\
+                                  output_core_dims=[["nlat","nlon"]],\
+                                  dask="parallelized",\
+                                  output_dtypes=[np.float64],\
+                                  dask_gufunc_kwargs={"allow_rechunk": True})
     var_zint_map.attrs = attr
     var_zint_map.name = tracer.name + "_zint" 
-    var_zint_map = var_zint_map.drop(("ULONG","ULAT"))
-    return var_zint_map.where(var_zint_map != 0.)
+    return var_zint_map
 
 #*****************************************************************************#
+@guvectorize(["void(float64[:], float64[:], float64[:])"], "(t),(t)->(t)",\
+             nopython=True, target="cpu")
+def _tend_kernel (v, dt, out):
+    """
+    dX/dt of one time series, NaN at both ends
+    """
+    n = v.shape[0]
+    for i in range(n):
+        out[i] = np.nan
+    for i in range(1, n-1):
+        # apprx to end of month: X_t = [v_t + v_(t+1)]/2
+        # dX = X_t - X_(t-1)
+        out[i] = (0.5*(v[i] + v[i+1]) - 0.5*(v[i-1] + v[i]))/dt[i]
+
 def tracer_budget_tend_appr (TRACER, time_bnd, var_zint):
     """
     Computes approximate TRACER budget tendency given vertically-integrated POP
@@ -106,20 +282,52 @@ def tracer_budget_tend_appr (TRACER, time_bnd, var_zint):
     long_name = var_zint.long_name + " tendency"
     attr = {"long_name" : long_name, "units" : units}
     
-    # apprx to end of month 
-    # X = [X_t + X_(t+1)]/2
-    X = (var_zint + var_zint.shift(time=-1))*0.5
-    
-    # X = X_t - X_(t-1)
-    dX = X - X.shift(time=1)
-    
-    #units per seconds
-    var_zint_tend = dX/dt
-    var_zint_tend.attrs = attr
-    var_zint_tend.name = TRACER.lower() + "_tend"
-    return var_zint_tend
+    # centered difference per (y,x) column, units per seconds
+    var_zint_tend = xr.apply_ufunc(_tend_kernel, var_zint, dt,\
+                                   input_core_dims=[["time"],["time"]],\
+                                   output_core_dims=[["time"]],\
+                                   dask="parallelized",\
+                                   output_dtypes=[np.float64],\
+                                   dask_gufunc_kwargs={"allow_rechunk": True})
+    var_zint_tend = var_zint_tend.transpose(*var_zint.dims)
+    return _finalize(var_zint_tend, TRACER.lower() + "_tend", attr)
 
 #*****************************************************************************#
+@njit(fastmath=_FASTMATH)
+def _hdiv_zint (ue, vn, vol):
+    """
+    Arguments: ue(t,z,y,x), vn(t,z,y,x) east/north tracer fluxes, vol(z,y,x)
+    Returns Int_z{(uw-ue) + (vs-vn)}(t,y,x) of the volume weighted fluxes,
+    computed and accumulated in float64; west/south neighbours wrap around
+    like DataArray.roll; levels where the divergence is NaN are skipped and
+    zero integrals (land) are NaN
+    """
+    # separate C-contiguous arrays, x innermost: unit-stride (SIMD) loads
+    ue = np.ascontiguousarray(ue)
+    vn = np.ascontiguousarray(vn)
+    vol = np.ascontiguousarray(vol)
+    nt, nz, ny, nx = ue.shape
+    out = np.empty((nt, ny, nx))
+    acc = np.empty(nx)
+    for t in range(nt):
+        for j in range(ny):
+            jm = j-1 if j > 0 else ny-1         # Tcell_(i,j-1)
+            acc[:] = 0.
+            for k in range(nz):
+                for i in range(nx):
+                    im = i-1 if i > 0 else nx-1 # Tcell_(i-1,j)
+                    # float64 products: the divergence cancels nearly equal fluxes
+                    ue_c = np.float64(ue[t,k,j,i])*vol[k,j,i]
+                    vn_c = np.float64(vn[t,k,j,i])*vol[k,j,i]
+                    uw = np.float64(ue[t,k,j,im])*vol[k,j,im]
+                    vs = np.float64(vn[t,k,jm,i])*vol[k,jm,i]
+                    hdiv = (uw-ue_c) + (vs-vn_c)
+                    if not np.isnan(hdiv):
+                        acc[i] += hdiv
+            for i in range(nx):
+                out[t,j,i] = acc[i] if acc[i] != 0. else np.nan
+    return out
+
 def tracer_budget_lat_adv_resolved (f_ue, f_vn, TRACER, vol3d, \
                                     klo=0, khi=25, tlo=490, thi=610):
     """
@@ -139,8 +347,8 @@ def tracer_budget_lat_adv_resolved (f_ue, f_vn, TRACER, vol3d, \
     description = "Int_z{-Div[<"+var_name1+">, <"+var_name2+">]}"
     
     # read tracer associate variable
-    ds1 = read_cesm_pop (f_ue, 60)
-    ds2 = read_cesm_pop (f_vn, 60)
+    ds1 = _open_budget_var (f_ue, var_name1, keep=("z_w",))
+    ds2 = _open_budget_var (f_vn, var_name2)
     ue = (ds1[var_name1]).isel(z_t=slice(klo,khi),time=slice(tlo,thi))
     vn = (ds2[var_name2]).isel(z_t=slice(klo,khi),time=slice(tlo,thi))
     zlo = (ds1["z_w"]).isel(z_w=klo).values
@@ -150,20 +358,14 @@ def tracer_budget_lat_adv_resolved (f_ue, f_vn, TRACER, vol3d, \
             "depth_range" :  "{0:3.2f} - {1:3.2f} m".format((zlo/100),(zhi/100))}
     # vol3d
     vol = vol3d.isel(z_t=slice(klo,khi))
-    # e.g.: degC cm^3/s
-    ue = ue*vol  # Tcell_(i,j)
-    vn = vn*vol  # Tcell_(i,j)
-    # shift grid:
-    uw = ue.roll(nlon=1,roll_coords=False) # Tcell_(i-1,j)
-    vs = vn.roll(nlat=1,roll_coords=False) # Tcell_(i,j-1)
-    # Div [du/dx + du/dy]
-    hdiv = (uw-ue) + (vs-vn)
-    # vertical integration
-    var_lat_adv_res_map = hdiv.sum(dim="z_t",keep_attrs=True)
-    var_lat_adv_res_map.attrs = attr
-    var_lat_adv_res_map.name = TRACER.lower() + "_lat_adv_res"
-    var_lat_adv_res_map = var_lat_adv_res_map.drop(("ULONG","ULAT"))
-    return var_lat_adv_res_map.where(var_lat_adv_res_map != 0.)
+    # Div [du/dx + du/dy] and vertical integration, e.g.: degC cm^3/s
+    var_lat_adv_res_map = xr.apply_ufunc(_hdiv_zint, ue, vn, vol,\
+                                         input_core_dims=[["z_t","nlat","nlon"]]*3,\
+                                         output_core_dims=[["nlat","nlon"]],\
+                                         dask="parallelized",\
+                                         output_dtypes=[np.float64],\
+                                         dask_gufunc_kwargs={"allow_rechunk": True})
+    return _finalize(var_lat_adv_res_map, TRACER.lower() + "_lat_adv_res", attr)
 
 #*****************************************************************************#
 def tracer_budget_vert_adv_resolved (f_wt, TRACER, vol3d,\
@@ -184,7 +386,7 @@ def tracer_budget_vert_adv_resolved (f_wt, TRACER, vol3d,\
     attr = {"long_name" : long_name, "units" : units, "description" : description,\
             "k_range" : str(klo)+" - "+str(khi)}
     # read tracer associate variable
-    ds1 = read_cesm_pop (f_wt, 60)
+    ds1 = _open_budget_var (f_wt, var_name)
     wt = ds1[var_name].isel(time=slice(tlo,thi))
     wt = wt.rename({"z_w_top" : "z_t"})
     wt["z_t"] = vol3d.z_t
@@ -196,10 +398,7 @@ def tracer_budget_vert_adv_resolved (f_wt, TRACER, vol3d,\
     var_bottom = var_bottom.where(~np.isnan(var_bottom),0.)
     # vertical convergence
     var_vert_adv_res_map = (var_bottom - var_top)
-    var_vert_adv_res_map.attrs = attr
-    var_vert_adv_res_map.name = TRACER.lower()+"_vert_adv_res"
-    var_vert_adv_res_map = var_vert_adv_res_map.drop(("ULONG","ULAT"))
-    return var_vert_adv_res_map
+    return _finalize(var_vert_adv_res_map, TRACER.lower()+"_vert_adv_res", attr)
 
 #*****************************************************************************#
 def tracer_budget_hmix (f_e, f_n, TRACER, vol3d,\
@@ -220,8 +419,8 @@ def tracer_budget_hmix (f_e, f_n, TRACER, vol3d,\
     long_name = "lateral diffusive flux (resolved)"
     description = "Int_z{-Div[<"+var_name1+">, <"+var_name2+">]}"
     # read tracer associate variable
-    ds1 = read_cesm_pop (f_e, 60) 
-    ds2 = read_cesm_pop (f_n, 60) 
+    ds1 = _open_budget_var (f_e, var_name1, keep=("z_w",))
+    ds2 = _open_budget_var (f_n, var_name2)
     
     ue = (ds1[var_name1]).isel(z_t=slice(klo,khi),time=slice(tlo,thi))
     vn = (ds2[var_name2]).isel(z_t=slice(klo,khi),time=slice(tlo,thi))
@@ -233,27 +432,24 @@ def tracer_budget_hmix (f_e, f_n, TRACER, vol3d,\
             "depth_range" :  "{0:3.2f} - {1:3.2f} m".format((zlo/100),(zhi/100))}
     # vol3d
     vol = vol3d.isel(z_t=slice(klo,khi))
-    # e.g.: degC cm^3/s
-    ue = ue*vol  # Tcell_(i,j)
-    vn = vn*vol  # Tcell_(i,j)
     
-    # shift
-    uw = ue.roll(nlon=1,roll_coords=False)  # Tcell_(i-1,j)
-    vs = vn.roll(nlat=1,roll_coords=False)  # Tcell_(i,j-1)
-    
-    # Divergence
-    hdiv = (uw-ue) + (vs-vn)
-    #hdiv = (ue-uw) + (vn-vs)
-    # copy coordinates
-    #hdiv = hdiv.assign_coords(TLAT=ue.coords.get("TLAT"))
-    # vertical integration
-    var_lat_mix_res_map = hdiv.sum(dim="z_t")
-    var_lat_mix_res_map.attrs = attr
-    var_lat_mix_res_map.name = TRACER.lower() + "_lat_mix_res"
-    var_lat_mix_res_map = var_lat_mix_res_map.drop(("ULONG","ULAT"))
-    return var_lat_mix_res_map.where(var_lat_mix_res_map != 0.)
+    # Divergence and vertical integration, e.g.: degC cm^3/s
+    var_lat_mix_res_map = xr.apply_ufunc(_hdiv_zint, ue, vn, vol,\
+                                         input_core_dims=[["z_t","nlat","nlon"]]*3,\
+                                         output_core_dims=[["nlat","nlon"]],\
+                                         dask="parallelized",\
+                                         output_dtypes=[np.float64],\
+                                         dask_gufunc_kwargs={"allow_rechunk": True})
+    return _finalize(var_lat_mix_res_map, TRACER.lower() + "_lat_mix_res", attr)
 
 #*****************************************************************************#
+def _vmix_conv (field_top, field_bot, area_top, area_bot):
+    """
+    -(F_bot*A_bot - F_top*A_top), a NaN bottom flux counts as zero
+    """
+    flux_bot = field_bot*area_bot
+    return -(np.where(np.isnan(flux_bot), 0., flux_bot) - field_top*area_top)
+
 def tracer_budget_dia_vmix (f_dia, TRACER, tarea, kmt, \
                             klo=0, khi=25, tlo=912, thi=1032):
     """
@@ -272,22 +468,25 @@ def tracer_budget_dia_vmix (f_dia, TRACER, tarea, kmt, \
             "k_range" : str(klo)+" - "+str(khi)}
     
     # read tracer associate variable
-    ds = read_cesm_pop (f_dia, 60)
+    ds = _open_budget_var (f_dia, var_name)
     FIELD = ds[var_name].isel(time=slice(tlo,thi)) # degC cm/s
-    # degC cm^3/s
-    FIELD = FIELD*tarea
     # zero diffusive flux across sea surface -> 0 
     FIELD_TOP = FIELD.isel(z_w_bot=klo)
     FIELD_BOT = FIELD.isel(z_w_bot=khi)
-    #tarea_bot = tarea.where(kmt > khi,0.)
-    #tarea_top = tarea.where(kmt > klo,0.)
-    #
-    FIELD_BOT = FIELD_BOT.fillna(0.)
-    var_vert_mix_map = -(FIELD_BOT.fillna(0.) - FIELD_TOP)
-    var_vert_mix_map.name = TRACER.lower() + "_dia_vmix"
-    var_vert_mix_map.attrs = attr
-    var_vert_mix_map = var_vert_mix_map.drop(("ULONG","ULAT"))
-    return var_vert_mix_map
+    tarea = _drop_ugrid_coords(tarea)
+    kmt = _drop_ugrid_coords(kmt)
+    # cell area, zero below the sea floor (kmt > 0 wherever FIELD is defined)
+    tarea_bot = tarea.where(kmt > khi,0.)
+    if klo == 0:
+        tarea_top = tarea
+    else:
+        tarea_top = tarea.where(kmt > klo,0.)
+    # degC cm^3/s
+    var_vert_mix_map = xr.apply_ufunc(_vmix_conv, FIELD_TOP, FIELD_BOT,\
+                                      tarea_top, tarea_bot,\
+                                      dask="parallelized",\
+                                      output_dtypes=[np.result_type(FIELD.dtype,tarea.dtype)])
+    return _finalize(var_vert_mix_map, TRACER.lower() + "_dia_vmix", attr)
 
 #*****************************************************************************#
 def tracer_budget_adi_vmix (f_adi, TRACER, vol3d, \
@@ -307,7 +506,7 @@ def tracer_budget_adi_vmix (f_adi, TRACER, vol3d, \
     attr = {"long_name" : long_name, "units" : units, "description" : description,\
             "k_range" : str(klo)+" - "+str(khi)}
     # read tracer associate variable
-    ds = read_cesm_pop (f_adi, 60)
+    ds = _open_budget_var (f_adi, var_name)
     FIELD = ds[var_name].isel(time=slice(tlo,thi)) # degC/s
     FIELD = FIELD.rename({"z_w_bot" : "z_t"})
     FIELD["z_t"] = vol3d.z_t
@@ -317,10 +516,7 @@ def tracer_budget_adi_vmix (f_adi, TRACER, vol3d, \
     FIELD_BOT = FIELD.isel(z_t=khi)
     #
     var_vert_mix_map = -(FIELD_BOT.fillna(0.) - FIELD_TOP)
-    var_vert_mix_map.attrs = attr
-    var_vert_mix_map.name = TRACER.lower() + "_adi_vmix"
-    var_vert_mix_map = var_vert_mix_map.drop(("ULONG","ULAT"))
-    return var_vert_mix_map
+    return _finalize(var_vert_mix_map, TRACER.lower() + "_adi_vmix", attr)
 
 #*****************************************************************************#
 def tracer_budget_sflux (f_flx, TRACER, var_name, area2d, tlo=912, thi=1032):
@@ -332,21 +528,23 @@ def tracer_budget_sflux (f_flx, TRACER, var_name, area2d, tlo=912, thi=1032):
     based on tracer_budget_srf_flux.ncl
     """
     # read tracer associate variable
-    ds = read_cesm_pop (f_flx, 60)
-    rho_sw = ds["rho_sw"]              # density of saltwater (g/cm^3)
+    ds = _open_budget_var (f_flx, var_name, keep=("rho_sw","cp_sw",\
+                           "latent_heat_vapor","latent_heat_fusion"))
+    # physical constants as python floats: scale_factor stays a scalar
+    rho_sw = ds["rho_sw"].values.item()  # density of saltwater (g/cm^3)
     rho_sw = rho_sw * 1.e-3             # (kg/cm^3)
-    cp_sw = ds["cp_sw"]                # spec. heat of saltwater (erg/g/K)
+    cp_sw = ds["cp_sw"].values.item()    # spec. heat of saltwater (erg/g/K)
     cp_sw = cp_sw * 1.e-7 * 1.e3        # (J/kg/K)
     rho_cp = rho_sw * cp_sw             # (J/cm^3/K)
-    latvap = ds["latent_heat_vapor"]   # lat heat of vaporiz. (J/kg)
-    latfus = ds["latent_heat_fusion"]  # lat heat of fusion (erg/g)
+    latvap = ds["latent_heat_vapor"].values.item()   # lat heat of vaporiz. (J/kg)
+    latfus = ds["latent_heat_fusion"].values.item()  # lat heat of fusion (erg/g)
     latfus = latfus * 1.e-7 * 1.e3      # (J/kg)
     # scale factors
     if var_name in ["SHF", "QFLUX", "SENH_F", "LWDN_F", "LWUP_F", "SHF_QSW", "MELTH_F"]:
         scale_factor = 1.e-4 * (1./rho_cp)          #W/m^2 -> degC cm/s
     elif var_name in ["SNOW_F","IOFF_F"]:
         scale_factor = -latfus*1.e-4 * (1./rho_cp)  #kg/m^2/s -> degC cm/s
-    elif var_name is "EVAP_F":
+    elif var_name == "EVAP_F":
         scale_factor = latvap*1.e-4 * (1./rho_cp)   #kg/m^2/s -> degC cm/s
     else :
         scale_factor = 1.
@@ -358,13 +556,10 @@ def tracer_budget_sflux (f_flx, TRACER, var_name, area2d, tlo=912, thi=1032):
         
     FIELD = ds[var_name].isel(time=slice(tlo,thi))
     var1 = FIELD * scale_factor
-    var_sflux_map = var1*area2d
+    var_sflux_map = var1*_drop_ugrid_coords(area2d)
     long_name = "vertical flux across sea surface"
     attr = {"long_name" : long_name, "units" : units}
-    var_sflux_map.attrs = attr
-    var_sflux_map.name = TRACER.lower() + "_" + var_name 
-    var_sflux_map = var_sflux_map.drop(("ULONG","ULAT"))
-    return var_sflux_map
+    return _finalize(var_sflux_map, TRACER.lower() + "_" + var_name, attr)
 
 #*****************************************************************************#
 def tracer_budget_kpp_src (f_kpp, TRACER, vol3d,\
@@ -374,11 +569,40 @@ def tracer_budget_kpp_src (f_kpp, TRACER, vol3d,\
     """
     var_name = "KPP_SRC_"+TRACER
     # read tracer associate variable
-    ds = read_cesm_pop (f_kpp, 60)
+    ds = _open_budget_var (f_kpp, var_name)
     KPP_SRC = ds[var_name].isel(time=slice(tlo,thi))
     #KPP_SRC = KPP_SRC.where(KPP_SRC != 0.)
     # compute temp flux
     temp_kpp_src = tracer_budget_var3d_zint_map(KPP_SRC,vol3d,klo,khi)
-    return temp_kpp_src
+    return _finalize(temp_kpp_src, temp_kpp_src.name, temp_kpp_src.attrs)
+
+#*****************************************************************************#
+def tracer_budget_all (TRACER, tracer, time_bnd, vol3d, tarea, kmt, area2d,\
+                       f_ue, f_vn, f_wt, f_e, f_n, f_dia, f_adi, f_flx, flx_name="SHF",\
+                       klo=0, khi=25, tlo=912, thi=1032):
+    """
+    Collects the tracer budget terms in a single Dataset without computing
+    them, so one ds.to_netcdf()/ds.compute() submits the whole dask graph
+    Arguments: tracer(t,z,y,x) and time_bnd already sliced to tlo:thi,
+               f_* : file(s) read by each budget term,
+               flx_name : surface flux variable in f_flx
+    """
+    # one in-memory vol3d (~30 MB) shared by every term; the lateral
+    # stencils index their neighbours directly, no shifted copies needed
+    vol3d = vol3d.persist()
+    var_zint = tracer_budget_var3d_zint_map(tracer, vol3d, klo, khi)
+    budget = {
+        "tend" : tracer_budget_tend_appr(TRACER, time_bnd, var_zint),
+        "lat_adv" : tracer_budget_lat_adv_resolved(f_ue, f_vn, TRACER, vol3d,\
+                                                   klo, khi, tlo, thi),
+        "vert_adv" : tracer_budget_vert_adv_resolved(f_wt, TRACER, vol3d,\
+                                                     klo, khi, tlo, thi),
+        "hmix" : tracer_budget_hmix(f_e, f_n, TRACER, vol3d, klo, khi, tlo, thi),
+        "dia_vmix" : tracer_budget_dia_vmix(f_dia, TRACER, tarea, kmt,\
+                                            klo, khi, tlo, thi),
+        "adi_vmix" : tracer_budget_adi_vmix(f_adi, TRACER, vol3d, klo, khi, tlo, thi),
+        "sflux" : tracer_budget_sflux(f_flx, TRACER, flx_name, area2d, tlo, thi),
+    }
+    return xr.Dataset(budget)
 
 #*****************************************************************************#